@@ -0,0 +1,11 @@
+# encoding: utf-8
+
+# Tests of Berreman4x4. Run with "python -m pytest tests" from the root 
+# directory of the repository.
+
+import os, sys
+
+import matplotlib
+matplotlib.use("Agg")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,84 @@
+# encoding: utf-8
+
+# Tests of the PropagatorCache of the layers.
+
+import pickle
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi
+
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+glass = Berreman4x4.IsotropicNonDispersiveMaterial(1.5)
+
+def make_structure(cache):
+    """Returns (structure, law): a dispersive layer on glass."""
+    law = Berreman4x4.DispersionSellmeier([0.696, 0.068e-6], 
+                                          [0.407, 0.116e-6])
+    material = Berreman4x4.IsotropicDispersive(law)
+    layer = Berreman4x4.HomogeneousIsotropicLayer(material, 500e-9)
+    layer.setCache(cache)
+    s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(air), [layer], 
+                              Berreman4x4.IsotropicHalfSpace(glass))
+    return (s, law, layer)
+
+Kx = numpy.linspace(0, 0.9, 5)
+k0 = 2*pi/600e-9
+
+def test_hits():
+    cache = Berreman4x4.PropagatorCache()
+    (s, law, layer) = make_structure(cache)
+    J1 = numpy.asarray(s.getJones(Kx, k0))
+    J2 = numpy.asarray(s.getJones(Kx, k0))
+    assert cache.hits == 1 and cache.misses == 1
+    numpy.testing.assert_array_equal(J1, J2)
+
+def test_law_change():
+    """A change of the dispersion law is detected without clear()."""
+    cache = Berreman4x4.PropagatorCache()
+    (s, law, layer) = make_structure(cache)
+    (s_ref, law_ref, layer_ref) = make_structure(None)
+    s.getJones(Kx, k0)
+    p = law.getParameters() * 1.2
+    law.setParameters(p)
+    law_ref.setParameters(p)
+    J = numpy.asarray(s.getJones(Kx, k0))
+    J_ref = numpy.asarray(s_ref.getJones(Kx, k0))
+    numpy.testing.assert_allclose(J, J_ref, atol=1e-14)
+    assert cache.misses == 2
+
+def test_thickness_change():
+    cache = Berreman4x4.PropagatorCache()
+    (s, law, layer) = make_structure(cache)
+    J1 = numpy.asarray(s.getJones(Kx, k0))
+    layer.setThickness(700e-9)
+    J2 = numpy.asarray(s.getJones(Kx, k0))
+    assert numpy.abs(J1 - J2).max() > 1e-3
+
+def test_eviction():
+    cache = Berreman4x4.PropagatorCache(maxsize=2)
+    (s, law, layer) = make_structure(cache)
+    for K in (0.1, 0.2, 0.3):
+        s.getJones(K, k0)
+    assert len(cache) == 2
+
+def test_pickle():
+    cache = Berreman4x4.PropagatorCache()
+    (s, law, layer) = make_structure(cache)
+    J1 = numpy.asarray(s.getJones(Kx, k0))
+    s2 = pickle.loads(pickle.dumps(s))
+    assert len(s2.layers[0].cache) == 0
+    numpy.testing.assert_array_equal(J1, numpy.asarray(s2.getJones(Kx, k0)))
+
+def test_mark_changed():
+    """A change of a tensor in place is declared with markChanged()."""
+    material = Berreman4x4.UniaxialNonDispersiveMaterial(1.5, 1.7)
+    layer = Berreman4x4.HomogeneousLayer(material, 500e-9)
+    cache = Berreman4x4.PropagatorCache()
+    layer.setCache(cache)
+    P1 = layer.getPropagationArray(Kx, k0)
+    material.epsilon[2,2] = 2.0
+    layer.markChanged()
+    assert len(cache) == 0
+    P2 = layer.getPropagationArray(Kx, k0)
+    assert numpy.abs(P1 - P2).max() > 1e-3
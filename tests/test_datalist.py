@@ -0,0 +1,74 @@
+# encoding: utf-8
+
+# Tests of the columnar storage of DataList.
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi
+
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+glass = Berreman4x4.IsotropicNonDispersiveMaterial(1.5)
+uniaxial = Berreman4x4.UniaxialNonDispersiveMaterial(1.5, 1.7)
+
+Kx = numpy.linspace(0, 0.9, 7)
+k0 = 2*pi/numpy.array([[500e-9], [600e-9], [700e-9]])
+
+def make_data():
+    s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(air), 
+                              [Berreman4x4.HomogeneousLayer(uniaxial, 300e-9)],
+                              Berreman4x4.IsotropicHalfSpace(glass))
+    return s.sweep(Kx, k0)
+
+def test_from_arrays():
+    data = make_data()
+    data2 = Berreman4x4.DataList.from_arrays(data.Kx, data.k0, 
+                                             data.T_ri, data.T_ti)
+    numpy.testing.assert_array_equal(data2.T_ri, data.T_ri)
+    numpy.testing.assert_array_equal(data2.R, data.R)
+
+def test_slice():
+    data = make_data()
+    sub = data[1:, ::2]
+    numpy.testing.assert_array_equal(sub.T_ri, data.T_ri[1:, ::2])
+    numpy.testing.assert_array_equal(sub.Kx, data.Kx[1:, ::2])
+    assert [a[0] for a in sub.axes] == ["k0", "Kx"]
+    numpy.testing.assert_array_equal(sub.axes[0][1], k0.ravel()[1:])
+    numpy.testing.assert_array_equal(sub.axes[1][1], Kx[::2])
+
+def test_slice_row():
+    data = make_data()
+    row = data[2]
+    numpy.testing.assert_array_equal(row.T_ti, data.T_ti[2])
+    assert len(row.axes) == 1 and row.axes[0][0] == "Kx"
+    numpy.testing.assert_array_equal(row.axes[0][1], Kx)
+    column = data[:, 3]
+    assert len(column.axes) == 1 and column.axes[0][0] == "k0"
+    assert data[[0, 2]].axes is None
+
+def test_save_load(tmp_path):
+    data = make_data()
+    path = str(tmp_path / "data.b4x4")
+    data.save(path)
+    for mmap in (True, False):
+        loaded = Berreman4x4.DataList.load(path, mmap)
+        assert loaded.changed and not hasattr(loaded, "R")
+        loaded.update()
+        for k in ("Kx", "k0", "T_ri", "T_ti", "power_corr"):
+            numpy.testing.assert_array_equal(getattr(loaded, k), 
+                                             getattr(data, k))
+        for (a, b) in zip(loaded.axes, data.axes):
+            assert a[0] == b[0]
+            numpy.testing.assert_array_equal(a[1], b[1])
+        sub = loaded[1, 2:5]
+        numpy.testing.assert_array_equal(sub.R, data.R[1, 2:5])
+        numpy.testing.assert_array_equal(sub.axes[0][1], Kx[2:5])
+
+def test_save_load_list(tmp_path):
+    """A DataList with list storage is saved as a columnar DataList."""
+    data = make_data()
+    records = Berreman4x4.DataList([data[0, i] for i in range(len(Kx))])
+    path = str(tmp_path / "list.b4x4")
+    records.save(path)
+    loaded = Berreman4x4.DataList.load(path)
+    numpy.testing.assert_array_equal(loaded[:].T_ri, data.T_ri[0])
+    assert loaded.axes is None
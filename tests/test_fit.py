@@ -0,0 +1,118 @@
+# encoding: utf-8
+
+# Tests of EllipsometryFit: derivatives of the residuals, fits of synthetic
+# data.
+
+import numpy
+import pytest
+import Berreman4x4
+from Berreman4x4 import pi
+
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+Si = Berreman4x4.IsotropicNonDispersiveMaterial(3.9 + 0.02j)
+
+lbda = numpy.linspace(400e-9, 800e-9, 15)
+Phi = numpy.radians([55, 65, 75])
+
+h_true = (100e-9, 40e-9)
+coeffs_true = (1.1, 90e-9)
+
+def make_structure(h=h_true, coeffs=coeffs_true):
+    """Returns an oxide (Sellmeier law) and a nitride (table) layer on 
+    silicon, and the parameters of the fit."""
+    oxide = Berreman4x4.IsotropicDispersive(
+                Berreman4x4.DispersionSellmeier(list(coeffs)))
+    table = Berreman4x4.DispersionTable(numpy.linspace(350e-9, 850e-9, 6), 
+                                        [2.1+0.1j, 2.0+0.08j, 1.95+0.05j, 
+                                         1.9+0.03j, 1.88+0.02j, 1.87+0.01j])
+    nitride = Berreman4x4.IsotropicDispersive(table)
+    layers = [Berreman4x4.HomogeneousIsotropicLayer(oxide, h[0]), 
+              Berreman4x4.HomogeneousIsotropicLayer(nitride, h[1])]
+    s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(air), layers, 
+                              Berreman4x4.IsotropicHalfSpace(Si))
+    parameters = [Berreman4x4.ThicknessParameter(layers[0]), 
+                  Berreman4x4.ThicknessParameter(layers[1]),
+                  Berreman4x4.DispersionParameter(oxide, 0),
+                  Berreman4x4.DispersionParameter(oxide, 1),
+                  Berreman4x4.DispersionParameter(nitride, 2),
+                  Berreman4x4.DispersionParameter(nitride, 9)]
+    return (s, parameters)
+
+def make_data():
+    """Returns the synthetic data of the structure with the true values."""
+    (s, parameters) = make_structure()
+    zeros = numpy.zeros((len(Phi), len(lbda)))
+    data = Berreman4x4.EllipsometryData(lbda, Phi, zeros, zeros)
+    (Kx, k0) = data.getGrid(s.frontHalfSpace)
+    T_ri = numpy.asarray(s.getJones(Kx, k0)[0])
+    (Psi, Delta) = Berreman4x4.DataList.getEllipsometryParameters(T_ri)
+    return Berreman4x4.EllipsometryData(lbda, Phi, Psi[...,0,0], 
+                                        Delta[...,0,0], 0.01, 0.05)
+
+data = make_data()
+
+def test_jacobian():
+    """Derivatives of the residuals, against central differences."""
+    (s, parameters) = make_structure()
+    fit = Berreman4x4.EllipsometryFit(s, data, parameters)
+    x = fit.getValues()
+    (r, J) = fit.getResidualsAndJacobian()
+    assert J.shape == (len(data), len(parameters))
+    for j in range(len(parameters)):
+        dx = numpy.zeros(len(x))
+        dx[j] = 1e-6 * abs(x[j])
+        fit.setValues(x + dx)
+        r_plus = fit.getResiduals()
+        fit.setValues(x - dx)
+        r_minus = fit.getResiduals()
+        fd = (r_plus - r_minus) / (2 * dx[j])
+        numpy.testing.assert_allclose(J[:,j], fd, rtol=0, 
+                                      atol=1e-6 * abs(fd).max())
+    fit.setValues(x)
+    numpy.testing.assert_allclose(fit.getResiduals(), r, rtol=0, atol=1e-9)
+
+def test_recovery():
+    """Fit of the thicknesses and of the Sellmeier coefficients."""
+    (s, parameters) = make_structure((90e-9, 45e-9), (1.0, 100e-9))
+    fit = Berreman4x4.EllipsometryFit(s, data, parameters[:4])
+    x = fit.fit()
+    assert fit.converged
+    assert fit.chi2 < 1e-12
+    numpy.testing.assert_allclose(x, h_true + coeffs_true, rtol=1e-6)
+    numpy.testing.assert_allclose(fit.getValues(), x, rtol=0, atol=0)
+    sigma = numpy.sqrt(numpy.diag(fit.getCovariance()))
+    assert numpy.all(numpy.isfinite(sigma))
+
+def test_bounds():
+    """The values are kept in the bounds, including the initial ones."""
+    (s, parameters) = make_structure((130e-9, 40e-9))
+    parameters[0].bounds = (0, 90e-9)
+    fit = Berreman4x4.EllipsometryFit(s, data, parameters[:1])
+    x = fit.fit()
+    assert x[0] == 90e-9
+    assert s.layers[0].h == 90e-9
+
+def test_warm_start():
+    """A second fit starts from the values and the damping of the first."""
+    (s, parameters) = make_structure((90e-9, 45e-9))
+    fit = Berreman4x4.EllipsometryFit(s, data, parameters[:2])
+    x = fit.fit()
+    n_iter = fit.n_iter
+    damping = fit.damping
+    assert n_iter > 2
+    assert damping != Berreman4x4.EllipsometryFit.damping
+    numpy.testing.assert_allclose(fit.fit(), x, rtol=1e-12)
+    assert fit.n_iter == 1
+
+def test_covariance():
+    (s, parameters) = make_structure((90e-9, 45e-9))
+    # The oxide of another structure: the residuals do not depend on it
+    (s2, parameters2) = make_structure()
+    fit = Berreman4x4.EllipsometryFit(s, data, parameters[:2] + 
+                                      parameters2[2:3])
+    with pytest.raises(ValueError):
+        fit.getCovariance()
+    fit.fit()
+    C = fit.getCovariance()
+    assert numpy.all(numpy.isfinite(C))
+    assert C[2,2] == 0
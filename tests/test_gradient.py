@@ -0,0 +1,75 @@
+# encoding: utf-8
+
+# Tests of Structure.getJonesGradient() against finite differences.
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi, e_y
+
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+glass = Berreman4x4.IsotropicNonDispersiveMaterial(1.5)
+TiO2 = Berreman4x4.IsotropicNonDispersiveMaterial(2.4 + 0.01j)
+epsilon = numpy.diag([2.25 + 0.02j, 2.4, 2.9])
+R = numpy.asarray(Berreman4x4.rotation_v_theta(e_y, 0.7))
+epsilon = R @ epsilon @ R.T
+
+Kx = numpy.array([[0.0], [0.4], [0.8]])
+k0 = 2*pi/numpy.array([500e-9, 650e-9])
+
+def make_structure(epsilon=epsilon, h=(120e-9, 80e-9, 300e-9)):
+    """Returns the structure, and its layers."""
+    layers = [Berreman4x4.HomogeneousIsotropicLayer(TiO2, h[0]),
+              Berreman4x4.HomogeneousIsotropicLayer(glass, h[1]),
+              Berreman4x4.HomogeneousLayer(
+                    Berreman4x4.NonDispersiveMaterial(epsilon), h[2])]
+    repeated = Berreman4x4.RepeatedLayers(layers[:2], 3, 1, 1)
+    s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(air), 
+                              [repeated, layers[2]], 
+                              Berreman4x4.IsotropicHalfSpace(glass))
+    return (s, layers)
+
+def jones(**kw):
+    (s, layers) = make_structure(**kw)
+    return numpy.array(s.getJones(Kx, k0))
+
+def test_thickness():
+    (s, layers) = make_structure()
+    g = s.getJonesGradient(Kx, k0, layers, tensors=False)
+    h = numpy.array([120e-9, 80e-9, 300e-9])
+    for p in range(3):
+        dh = numpy.zeros(3)
+        dh[p] = 1e-12
+        dT = (jones(h=h+dh) - jones(h=h-dh)) / 2e-12
+        scale = abs(dT).max()
+        numpy.testing.assert_allclose(g.dT_ri_dh[p], dT[0], 
+                                      rtol=0, atol=1e-6*scale)
+        numpy.testing.assert_allclose(g.dT_ti_dh[p], dT[1], 
+                                      rtol=0, atol=1e-6*scale)
+
+def test_tensor():
+    (s, layers) = make_structure()
+    g = s.getJonesGradient(Kx, k0, layers[2:])
+    for (j, k) in ((0,0), (0,2), (2,0), (1,1)):
+        de = numpy.zeros((3,3))
+        de[j,k] = 1e-6
+        dT = (jones(epsilon=epsilon+de) - jones(epsilon=epsilon-de)) / 2e-6
+        numpy.testing.assert_allclose(g.dT_ri_deps[0,j,k], dT[0], 
+                                      rtol=0, atol=1e-7)
+        numpy.testing.assert_allclose(g.dT_ti_deps[0,j,k], dT[1], 
+                                      rtol=0, atol=1e-7)
+
+def test_ellipsometry():
+    (s, layers) = make_structure()
+    g = s.getJonesGradient(Kx, k0, layers[2:], tensors=False)
+    (dPsi, dDelta) = g.getEllipsometryDerivatives(g.dT_ri_dh[0])
+    angles = []
+    for h in (300e-9 + 1e-12, 300e-9 - 1e-12):
+        (s, layers) = make_structure(h=(120e-9, 80e-9, h))
+        T_ri = numpy.asarray(s.getJones(Kx, k0)[0])
+        angles.append(Berreman4x4.DataList.getEllipsometryParameters(T_ri))
+    for (i, d) in enumerate((dPsi, dDelta)):
+        fd = (angles[0][i] - angles[1][i]) / 2e-12
+        # Element pp only: the tensor axes are in the plane of incidence, so
+        # that the cross-polarization elements vanish
+        numpy.testing.assert_allclose(d[...,0,0], fd[...,0,0], 
+                                      rtol=1e-5, atol=0)
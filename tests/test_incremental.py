@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+# Tests of the incremental evaluation of a Structure (setIncremental()).
+
+import copy, pickle
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi
+
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+glass = Berreman4x4.IsotropicNonDispersiveMaterial(1.5)
+TiO2 = Berreman4x4.IsotropicNonDispersiveMaterial(2.4)
+SiO2 = Berreman4x4.IsotropicNonDispersiveMaterial(1.46)
+uniaxial = Berreman4x4.UniaxialNonDispersiveMaterial(1.5, 1.7)
+
+Kx = numpy.linspace(0, 0.9, 7)
+k0 = 2*pi/numpy.array([[500e-9], [600e-9]])
+
+def make_structure():
+    layers = [Berreman4x4.HomogeneousIsotropicLayer(TiO2 if i%2 else SiO2, 
+                                                    (60 + 7*i) * 1e-9)
+              for i in range(8)]
+    layers.insert(3, Berreman4x4.HomogeneousLayer(uniaxial, 300e-9))
+    return Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(air), layers,
+                                 Berreman4x4.IsotropicHalfSpace(glass))
+
+def reference(s):
+    """Returns the propagators of a copy of 's', evaluated in full."""
+    s = copy.deepcopy(s)
+    s.setIncremental(False)
+    return (s.getPropagationArray(Kx, k0), 
+            s.getPropagationArray(Kx, k0, inv=True))
+
+def check(s):
+    (P, P_inv) = reference(s)
+    numpy.testing.assert_allclose(s.getPropagationArray(Kx, k0), P, 
+                                  rtol=0, atol=1e-12)
+    numpy.testing.assert_allclose(s.getPropagationArray(Kx, k0, inv=True), 
+                                  P_inv, rtol=0, atol=1e-12)
+
+def test_single_layer_changes():
+    """Each layer in turn, including the first and the last ones."""
+    s = make_structure()
+    s.setIncremental(True)
+    check(s)
+    for L in s.layers:
+        L.setThickness(L.h * 1.1)
+        check(s)
+
+def test_several_layers_change():
+    s = make_structure()
+    s.setIncremental(True)
+    check(s)
+    s.layers[1].setThickness(50e-9)
+    s.layers[6].setThickness(80e-9)
+    check(s)
+    s.layers[0].setMaterial(TiO2)
+    s.layers[-1].setMaterial(SiO2)
+    check(s)
+
+def test_replaced_layer():
+    s = make_structure()
+    s.setIncremental(True)
+    check(s)
+    s.layers[4] = Berreman4x4.HomogeneousIsotropicLayer(TiO2, 10e-9)
+    check(s)
+
+def test_material_change():
+    """A change of the dispersion law is detected with the layer version."""
+    law = Berreman4x4.DispersionSellmeier([0.696, 0.068e-6])
+    s = make_structure()
+    s.layers[2].setMaterial(Berreman4x4.IsotropicDispersive(law))
+    s.setIncremental(True)
+    check(s)
+    law.setParameters([0.9, 0.07e-6])
+    check(s)
+
+def test_jones():
+    s = make_structure()
+    s.setIncremental(True)
+    s.getJones(Kx, k0)
+    s.layers[5].setThickness(42e-9)
+    J = numpy.asarray(s.getJones(Kx, k0))
+    s.setIncremental(False)
+    numpy.testing.assert_allclose(J, numpy.asarray(s.getJones(Kx, k0)), 
+                                  rtol=0, atol=1e-12)
+
+def test_pickle():
+    s = make_structure()
+    s.setIncremental(True)
+    P = s.getPropagationArray(Kx, k0)
+    for s2 in (pickle.loads(pickle.dumps(s)), copy.deepcopy(s)):
+        assert s2.incremental
+        numpy.testing.assert_allclose(s2.getPropagationArray(Kx, k0), P, 
+                                      rtol=0, atol=1e-12)
+    s.setIncremental(False)
+    pickle.dumps(s)
+
+def test_sweep():
+    s = make_structure()
+    s.setIncremental(True)
+    data = s.sweep(Kx, k0, workers=4, chunk=3)
+    s.setIncremental(False)
+    (T_ri, T_ti) = s.getJones(Kx, k0)
+    numpy.testing.assert_allclose(data.T_ri, T_ri, rtol=0, atol=1e-12)
@@ -0,0 +1,136 @@
+# encoding: utf-8
+
+# Tests of InhomogeneousLayer with a TwistedMaterial.
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi, e_y
+
+LC = Berreman4x4.UniaxialNonDispersiveMaterial(1.5, 1.6)
+LC = LC.rotated(Berreman4x4.rotation_v_theta(e_y, pi/2))
+d = 2e-6
+
+k0 = 2*pi/numpy.linspace(450e-9, 700e-9, 3)
+Kx = numpy.array([[0.0], [0.3], [0.6]])
+
+def make_layer(evaluation="symplectic", div=25):
+    material = Berreman4x4.TwistedMaterial(LC, d, div=div)
+    return Berreman4x4.InhomogeneousLayer(material, evaluation, "eig")
+
+def test_rotating_frame():
+    """Exact at Kx = 0, sliced with the midpoint method for Kx ≠ 0."""
+    P = make_layer("rotating").getPropagationArray(Kx, k0)
+    P_fine = make_layer("symplectic", div=400).getPropagationArray(0, k0)
+    numpy.testing.assert_allclose(P[0], P_fine, rtol=0, atol=1e-8)
+    P_mid = make_layer("midpoint").getPropagationArray(Kx[1:], k0)
+    numpy.testing.assert_allclose(P[1:], P_mid, rtol=0, atol=1e-13)
+
+def test_adaptive_by_Kx():
+    """The points of a grid with the same Kx share a slicing."""
+    layer = make_layer()
+    layer.setAdaptive(1e-7)
+    P = layer.getPropagationArray(Kx, k0)
+    P_inv = layer.getPropagationArray(Kx, k0, inv=True)
+    assert len(layer._adaptive_slices) == len(Kx)
+    for (i, x) in enumerate(Kx[:,0]):
+        single = make_layer()
+        single.setAdaptive(1e-7)
+        numpy.testing.assert_allclose(P[i], single.getPropagationArray(x, k0),
+                                      rtol=0, atol=1e-14)
+    numpy.testing.assert_allclose(P_inv @ P, numpy.broadcast_to(
+                                  numpy.identity(4), P.shape), atol=1e-10)
+
+def test_adaptive_tolerance():
+    layer = make_layer()
+    layer.setAdaptive(1e-7)
+    P = layer.getPropagationArray(Kx, k0)
+    P_fine = make_layer(div=400).getPropagationArray(Kx, k0)
+    assert numpy.abs(P - P_fine).max() < 1e-7
+
+def test_symplectic_order():
+    """Fourth order convergence of the symplectic method (non-symmetric
+    slices), for the layer, a slice and a compiled structure."""
+    biaxial = Berreman4x4.BiaxialNonDispersiveMaterial((1.5, 1.6, 1.7))
+    biaxial = biaxial.rotated(Berreman4x4.rotation_v_theta(e_y, pi/3))
+    air = Berreman4x4.IsotropicHalfSpace(
+                Berreman4x4.IsotropicNonDispersiveMaterial(1.0))
+    def make(div):
+        material = Berreman4x4.TwistedMaterial(biaxial, d, 4*pi, div=div)
+        return Berreman4x4.InhomogeneousLayer(material, "symplectic", "eig")
+    k0 = 2*pi/600e-9
+    P_ref = make(1600).getPropagationArray(0.4, k0)
+    T_ref = Berreman4x4.Structure(air, [make(1600)], air).getJones(0.4, k0)
+    errors = []
+    compiled_errors = []
+    for div in (50, 100):
+        layer = make(div)
+        errors.append(abs(layer.getPropagationArray(0.4, k0) - P_ref).max())
+        s = Berreman4x4.Structure(air, [layer], air).compile()
+        compiled_errors.append(abs(s.getJones(0.4, k0)[0] - T_ref[0]).max())
+    assert errors[0] / errors[1] > 12
+    assert compiled_errors[0] / compiled_errors[1] > 12
+    layer = make(50)
+    (z1, z2) = (0.3e-6, 0.5e-6)
+    numpy.testing.assert_allclose(
+        layer.getSlicePropagator_sym(z2, z1, 0.4, k0), 
+        layer.getSlicePropagatorArray([z2], [z1], 0.4, k0)[0], 
+        rtol=0, atol=1e-13)
+
+def make_periodic(material, M, div, periodic, evaluation="midpoint"):
+    """Returns a layer of 'div' slices, with a period of M slices."""
+    angle = 2*pi * div / M
+    twisted = Berreman4x4.TwistedMaterial(material, d, angle, div=div)
+    layer = Berreman4x4.InhomogeneousLayer(twisted, evaluation, "eig")
+    layer.setPeriodic(periodic)
+    return layer
+
+tilted = Berreman4x4.UniaxialNonDispersiveMaterial(1.5, 1.6)
+tilted = tilted.rotated(Berreman4x4.rotation_v_theta(e_y, pi/3))
+
+# (material, M, div): the period of LC is π, i.e. M/2 slices
+periodic_cases = [(LC, 60, 150), (LC, 60, 160), (tilted, 60, 180), 
+                  (tilted, 60, 190)]
+
+def test_periodic():
+    """P_r·P_period^N, against the product of all the slices."""
+    for (material, M, div) in periodic_cases:
+        layer = make_periodic(material, M, div, True)
+        M_used = M//2 if material is LC else M
+        assert layer._getPeriod(2*pi/k0) == (div // M_used, M_used)
+        reference = make_periodic(material, M, div, False)
+        for inv in (False, True):
+            numpy.testing.assert_allclose(
+                layer.getPropagationArray(Kx, k0, inv), 
+                reference.getPropagationArray(Kx, k0, inv), 
+                rtol=0, atol=1e-12)
+
+def test_periodic_engines():
+    """Periodic layers with the scattering engine and compiled."""
+    air = Berreman4x4.IsotropicHalfSpace(
+                Berreman4x4.IsotropicNonDispersiveMaterial(1.0))
+    for (material, M, div) in periodic_cases:
+        layers = [make_periodic(material, M, div, periodic, "symplectic")
+                  for periodic in (True, False)]
+        (s, s_ref) = [Berreman4x4.Structure(air, [L], air) for L in layers]
+        T_ref = s_ref.getJones(Kx, k0)
+        numpy.testing.assert_allclose(s.compile().getJones(Kx, k0), T_ref,
+                                      rtol=0, atol=1e-12)
+        s.setEngine("scattering")
+        numpy.testing.assert_allclose(s.getJones(Kx, k0), T_ref,
+                                      rtol=0, atol=1e-12)
+
+def test_profile_cache():
+    """The eviction keeps the profile cache under its bound."""
+    layer = make_layer()
+    layer.profile_cache_size = 500
+    n = 3 * 25      # Positions of the symplectic slices
+    for lbda in numpy.linspace(450e-9, 700e-9, 12):
+        layer.getPropagationArray(Kx, 2*pi/lbda)
+        assert layer._profiles_size <= layer.profile_cache_size
+        assert layer._profiles_size == sum(eps.size // 9 for eps in 
+                                           layer._profiles.values())
+    assert len(layer._profiles) == 500 // n
+    # The profile of the last wavelength is kept: no eviction
+    keys = list(layer._profiles)
+    layer.getPropagationArray(Kx, 2*pi/700e-9)
+    assert list(layer._profiles) == keys
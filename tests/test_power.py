@@ -0,0 +1,44 @@
+# encoding: utf-8
+
+# Tests of powerPropagators().
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi, newaxis
+
+def period_propagators(Kx, k0):
+    """Returns the propagators of a period of a Bragg mirror."""
+    layers = [Berreman4x4.HomogeneousIsotropicLayer(
+                    Berreman4x4.IsotropicNonDispersiveMaterial(n), h)
+              for (n, h) in ((1.5, 100e-9), (2.0, 75e-9))]
+    return layers[1].getPropagationArray(Kx, k0) @ \
+           layers[0].getPropagationArray(Kx, k0)
+
+def test_eig():
+    k0 = 2*pi/numpy.linspace(400e-9, 800e-9, 41)
+    P = period_propagators(numpy.array([[0], [0.5]]), k0)
+    for n in (0, 1, 2, 17, 50):
+        P_n = numpy.linalg.matrix_power(P, n)
+        numpy.testing.assert_allclose(
+            Berreman4x4.powerPropagators(P, n, "squaring"), P_n, 
+            rtol=0, atol=1e-13)
+        numpy.testing.assert_allclose(
+            Berreman4x4.powerPropagators(P, n, "eig"), P_n, 
+            rtol=0, atol=1e-9 * abs(P_n).max())
+
+def test_fallback():
+    """Points with a singular eigenvector matrix are calculated by 
+    squaring."""
+    P = period_propagators(0.3, 2*pi/numpy.linspace(400e-9, 800e-9, 5))
+    # Defective matrix (Jordan block), like at the edge of a band gap
+    jordan = numpy.identity(4, dtype=complex)
+    jordan[0,1] = jordan[2,3] = 1
+    P = numpy.concatenate([P, jordan[newaxis]])
+    P_n = numpy.linalg.matrix_power(P, 20)
+    numpy.testing.assert_allclose(Berreman4x4.powerPropagators(P, 20, "eig"),
+                                  P_n, rtol=0, atol=1e-9 * abs(P_n).max())
+    numpy.testing.assert_array_equal(
+        Berreman4x4.powerPropagators(P, 20, "eig")[-1], P_n[-1])
+    # Forced fallback for all the points
+    numpy.testing.assert_array_equal(
+        Berreman4x4.powerPropagators(P, 20, "eig", cond_max=1), P_n)
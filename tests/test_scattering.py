@@ -0,0 +1,78 @@
+# encoding: utf-8
+
+# Tests of the scattering-matrix engine of Structure (setEngine()).
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi
+
+glass = Berreman4x4.IsotropicNonDispersiveMaterial(1.5)
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+metal = Berreman4x4.IsotropicNonDispersiveMaterial(0.2 + 3.5j)
+
+def tilted(n_o, n_e, angles):
+    """Returns a uniaxial material, rotated with Euler angles 'angles'."""
+    material = Berreman4x4.UniaxialNonDispersiveMaterial(n_o, n_e)
+    return material.rotated(Berreman4x4.rotation_Euler(angles))
+
+k0 = 2*pi/600e-9
+Kx = numpy.linspace(0, 1.45, 31)
+
+def compare(layers, atol=1e-10):
+    s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(glass), layers,
+                              Berreman4x4.IsotropicHalfSpace(air))
+    J_transfer = numpy.asarray(s.getJones(Kx, k0))
+    s.setEngine("scattering")
+    J_scattering = numpy.asarray(s.getJones(Kx, k0))
+    numpy.testing.assert_allclose(J_scattering, J_transfer, rtol=0, 
+                                  atol=atol)
+    return J_scattering
+
+def test_isotropic_gap():
+    """Frustrated total internal reflection in an air gap."""
+    compare([Berreman4x4.HomogeneousIsotropicLayer(air, 300e-9)])
+
+def test_tilted_anisotropic():
+    """The modes of a tilted uniaxial layer have Re(q) of the same sign."""
+    material = tilted(1.5, 1.9, (0.3, 0.8, 0.2))
+    compare([Berreman4x4.HomogeneousLayer(material, 400e-9)])
+
+def test_absorbing_anisotropic():
+    material = tilted(1.6 + 0.8j, 2.2 + 2.5j, (0.5, 1.1, -0.4))
+    compare([Berreman4x4.HomogeneousLayer(material, 150e-9),
+             Berreman4x4.HomogeneousIsotropicLayer(air, 100e-9)])
+
+def test_thick_metal():
+    """The transfer engine overflows, the scattering engine does not."""
+    layer = Berreman4x4.HomogeneousIsotropicLayer(metal, 20e-6)
+    s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(glass), [layer],
+                              Berreman4x4.IsotropicHalfSpace(air))
+    s.setEngine("scattering")
+    (T_ri, T_ti) = s.getJones(Kx, k0)
+    assert numpy.all(numpy.isfinite(T_ri)) and numpy.all(numpy.isfinite(T_ti))
+    assert numpy.abs(T_ti).max() < 1e-100
+    # Reflection of the glass/metal interface
+    s.setLayers([Berreman4x4.HomogeneousIsotropicLayer(metal, 500e-9)])
+    s.setEngine("transfer")
+    numpy.testing.assert_allclose(T_ri, numpy.asarray(s.getJones(Kx, k0)[0]),
+                                  rtol=0, atol=1e-8)
+
+def test_absorbing_mode_classification():
+    """Forward modes with Re(q) < 0 < Im(q), in a thick absorbing layer.
+    
+    For Kx > 1.1, a forward mode of this material has q ≈ -1+0.6j and a 
+    backward mode q ≈ 1-0.5j. Sorted by Re(q)+Im(q), the modes were 
+    exchanged, and the propagation factors overflowed.
+    """
+    material = tilted(1.7 + 3.1j, 1.05, (-2.89, 3.13, -0.25))
+    Kx = numpy.linspace(1.1, 1.45, 8)
+    T_ri = []
+    for h in (2e-6, 60e-6):
+        s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(glass), 
+                                  [Berreman4x4.HomogeneousLayer(material, h)],
+                                  Berreman4x4.IsotropicHalfSpace(air))
+        s.setEngine("scattering")
+        T_ri.append(numpy.asarray(s.getJones(Kx, k0)[0]))
+    # The layers are opaque: same reflection as a semi-infinite medium
+    assert numpy.all(numpy.isfinite(T_ri[1]))
+    numpy.testing.assert_allclose(T_ri[1], T_ri[0], rtol=0, atol=1e-9)
@@ -0,0 +1,63 @@
+# encoding: utf-8
+
+# Tests of Structure.iter_evaluate() and of the output sinks.
+
+import numpy
+import Berreman4x4
+from Berreman4x4 import pi
+
+air = Berreman4x4.IsotropicNonDispersiveMaterial(1.0)
+glass = Berreman4x4.IsotropicNonDispersiveMaterial(1.5)
+uniaxial = Berreman4x4.UniaxialNonDispersiveMaterial(1.5, 1.7)
+
+Kx = numpy.linspace(0, 0.9, 7)
+k0 = 2*pi/numpy.array([[500e-9], [600e-9], [700e-9]])
+
+s = Berreman4x4.Structure(Berreman4x4.IsotropicHalfSpace(air), 
+                          [Berreman4x4.HomogeneousLayer(uniaxial, 300e-9)],
+                          Berreman4x4.IsotropicHalfSpace(glass))
+(T_ri, T_ti) = s.getJones(Kx, k0)
+
+def test_iter_evaluate(tmp_path):
+    chunks = []
+    sinks = [Berreman4x4.CallbackSink(lambda i, data: chunks.append(i)),
+             Berreman4x4.NpySink(str(tmp_path / "map.npy")),
+             Berreman4x4.NpzSink(str(tmp_path / "map.npz"), compressed=True)]
+    n = 0
+    for data in s.iter_evaluate(Kx, k0, chunk=5, sinks=sinks):
+        numpy.testing.assert_allclose(
+            data.T_ri, numpy.reshape(T_ri, (-1,2,2))[n:n+len(data)], 
+            rtol=0, atol=1e-14)
+        n += len(data)
+    assert n == 21
+    assert chunks == [0, 5, 10, 15, 20]
+    assert all(sink.complete for sink in sinks)
+    records = numpy.load(str(tmp_path / "map.npy"))
+    assert records.shape == (3, 7)
+    numpy.testing.assert_allclose(records["T_ri"], T_ri, rtol=0, atol=1e-14)
+    numpy.testing.assert_allclose(records["T_ti"], T_ti, rtol=0, atol=1e-14)
+    numpy.testing.assert_array_equal(records["Kx"], 
+                                     numpy.broadcast_to(Kx, (3, 7)))
+    with numpy.load(str(tmp_path / "map.npz")) as archive:
+        numpy.testing.assert_array_equal(archive["T_ri"], records["T_ri"])
+        numpy.testing.assert_array_equal(archive["T_ti"], records["T_ti"])
+        numpy.testing.assert_array_equal(archive["power_corr"], 
+                                         records["power_corr"])
+
+def test_early_close(tmp_path):
+    """The sinks are closed, and the points not evaluated are marked."""
+    sinks = [Berreman4x4.NpySink(str(tmp_path / "map.npy")),
+             Berreman4x4.NpzSink(str(tmp_path / "map.npz"))]
+    iterator = s.iter_evaluate(Kx, k0, chunk=5, sinks=sinks)
+    next(iterator)
+    next(iterator)
+    iterator.close()
+    assert all(sink.complete is False for sink in sinks)
+    assert sinks[0]._array is None and sinks[1]._arrays is None
+    records = numpy.load(str(tmp_path / "map.npy")).reshape(-1)
+    with numpy.load(str(tmp_path / "map.npz")) as archive:
+        for a in (records["k0"], archive["k0"].ravel(), archive["Kx"].ravel()):
+            assert numpy.all(numpy.isfinite(a[:10]))
+            assert numpy.all(numpy.isnan(a[10:]))
+        numpy.testing.assert_array_equal(archive["T_ri"].reshape(-1,2,2)[:10],
+                                         records["T_ri"][:10])